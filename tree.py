@@ -1,14 +1,17 @@
 import streamlit as st
-from pyvis.network import Network
 import streamlit.components.v1 as components
-import json
-import os
+import copy
+import hashlib
 import uuid
-from datetime import date
-import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
+from types import MappingProxyType, SimpleNamespace
+from datetime import date, datetime, time
+import binascii
 from io import BytesIO
-import firebase_admin
-from firebase_admin import credentials, firestore
+from PIL import Image
 
 st.set_page_config(layout="wide")
 st.title("My Stylized Family Tree 🌳")
@@ -17,11 +20,60 @@ st.title("My Stylized Family Tree 🌳")
 DEFAULT_MALE_AVATAR_URL = "https://cdn-icons-png.flaticon.com/512/147/147142.png"
 DEFAULT_FEMALE_AVATAR_URL = "https://cdn-icons-png.flaticon.com/512/147/147137.png"
 DEFAULT_NONBINARY_AVATAR_URL = "https://cdn-icons-png.flaticon.com/512/1659/1659727.png"
+# Any other gender ('Gender Non-Binary', 'Prefer Not to Say', or unknown) falls back to the neutral avatar
+AVATAR_BY_GENDER = {
+    "Male": DEFAULT_MALE_AVATAR_URL,
+    "Female": DEFAULT_FEMALE_AVATAR_URL,
+}
+
+# --- Blank form values (copied with dict() whenever the add/edit form is reset) ---
+_EMPTY_FORM_PERSON_DATA = MappingProxyType({
+    'given_name': "", 'family_name': "", 'maiden_name': "",
+    'other_names': "", 'nickname': "", 'gender': "Male",
+    'dob': None, 'dod': None, 'married_to': "",
+    'divorced_from': "", 'parents': (), 'children': (),
+    'avatar_url': ""
+})
+
+# --- Notes shown at the bottom of the page ---
+NOTES = """
+- Nodes use circular avatar images.
+- Hover nodes to see detailed tooltip.
+- Edges show parent-child relationships.
+- Dashed edges show spouse relationships.
+- Tree layout is vertical and hierarchical for clarity.
+- **Data is now saved to and loaded from Firebase Firestore!** This enables persistence for deployed apps.
+    - Adds, edits and deletes are kept in your session until you click **Save to Cloud**; the banner above the tree shows how many people have unsaved changes.
+- Generation levels are now automatically calculated based on parent/child relationships.
+- New person IDs are automatically generated.
+- Date of Birth, Date of Death, Married To, and Divorced From fields have been added.
+- Name fields are now separated into Given Name, Family Name, Maiden Name, Other Names, and Nickname.
+- Date range for birth/death is expanded to allow older dates.
+- You can now choose a custom Avatar Image by providing a URL or uploading an image file!
+    - Uploaded images are stored in Firebase Storage when `storage_bucket` is set under `[firestore]` in the app secrets, and only the image URL is saved in Firestore. The bucket must allow public object URLs.
+    - Without a storage bucket, uploaded images are converted to a Base64 string and stored in Firestore.
+    - Uploaded images are shrunk to a 128x128 thumbnail before they are stored, and oversized images saved inline by earlier versions are shrunk when the tree is loaded and written back with the next save.
+- Form fields for editing now update immediately when you select a person from the dropdown.
+- A new 'Delete Person' section has been added to remove individuals from the tree.
+    - Deleting a person will also automatically remove all their associated relationships (parent, child, spouse) from other individuals in the tree.
+    - A confirmation step is included to prevent accidental deletion.
+    - Several people can be selected and deleted in one go; levels are recalculated once for the batch.
+    - Tick 'Also delete orphaned descendants' to also remove any descendants who would be left with no parents.
+- The empty band (horizontal scrollbar) above the visualization should now be removed! This was achieved by:
+    - Setting `width=\"99%\"` for the `pyvis.Network`.
+    - Setting `scrolling=False` for `st.components.v1.html`.
+    - Injecting custom CSS into the generated HTML to remove default `margin` and `padding` from the `body` and `html` tags within the iframe, and setting `overflow: hidden;`.
+- New Gender Options: Added "Gender Non-Binary" and "Prefer Not to Say" options for gender selection, with a neutral default avatar.
+"""
 
 # --- Functions to load and save data (Modified for Firebase Firestore) ---
 @st.cache_resource(ttl=3600) # Cache the Firestore connection
 def get_firestore_client():
     """Initializes Firebase Admin SDK and returns a Firestore client."""
+    # The SDK is imported on first use rather than at startup, so the page starts drawing sooner
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
     if not firebase_admin._apps: # Check if app is already initialized
         try:
             # Use st.secrets for secure credential access
@@ -46,140 +98,384 @@ def get_firestore_client():
             st.stop() # Stop the app if authentication fails
     return firestore.client() # If already initialized, just return the client
 
-def load_family_data():
+# Person IDs are uuid4 hex strings, so these split points cut the collection into roughly even
+# document-ID ranges; the first and last ranges are open-ended so IDs of any shape are still read
+ID_SHARD_BOUNDS = ("2", "4", "6", "8", "a", "c", "e")
+
+def stream_id_range(collection, lower, upper):
+    """Returns the documents whose ID falls in [lower, upper); None leaves that side unbounded."""
+    from firebase_admin.firestore import FieldFilter
+    from google.cloud.firestore_v1.field_path import FieldPath
+
+    query = collection
+    if lower is not None:
+        query = query.where(filter=FieldFilter(FieldPath.document_id(), ">=", collection.document(lower)))
+    if upper is not None:
+        query = query.where(filter=FieldFilter(FieldPath.document_id(), "<", collection.document(upper)))
+    return list(query.stream())
+
+def as_date(value):
+    # Firestore returns Timestamps (datetime subclasses); records saved by older versions hold ISO strings
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str) and value:
+        try:
+            return date.fromisoformat(value[:10])
+        except ValueError:
+            return value # Keep unparseable legacy values rather than dropping them
+    return value or None
+
+@st.cache_data(ttl=300, show_spinner=False) # Shared by all sessions; cleared on every save
+def fetch_family_data(collection_name):
+    """Reads every person document in the collection into a {person_id: data} dict."""
     db = get_firestore_client()
+    collection = db.collection(collection_name)
+    # Stream the ID ranges concurrently so the load waits on the slowest shard, not the sum of them all
+    bounds = (None,) + ID_SHARD_BOUNDS + (None,)
+    with ThreadPoolExecutor(max_workers=len(bounds) - 1) as executor:
+        shards = executor.map(stream_id_range, repeat(collection), bounds[:-1], bounds[1:])
+        docs = [doc for shard in shards for doc in shard]
+    family_data = {}
+    for doc in docs:
+        person_id = doc.id
+        data = doc.to_dict()
+        # Ensure lists are correctly handled (Firestore typically preserves list types)
+        # Dates are held as datetime.date in memory
+        data['dob'] = as_date(data.get('dob'))
+        data['dod'] = as_date(data.get('dod'))
+
+        # Ensure all expected fields are present with default values if missing
+        data.setdefault('given_name', '')
+        data.setdefault('family_name', '')
+        data.setdefault('maiden_name', '')
+        data.setdefault('other_names', '')
+        data.setdefault('nickname', '')
+        data.setdefault('gender', 'Male') # Default gender for existing data
+        data.setdefault('married_to', None)
+        data.setdefault('divorced_from', None)
+        # Parents/children are held as sets in memory for O(1) membership, add and discard. Every person
+        # always has both keys (new people get them in the submit handler), so the rest of the app indexes them directly.
+        data['parents'] = set(data.get('parents') or ())
+        data['children'] = set(data.get('children') or ())
+        data.setdefault('avatar_url', None) # Or appropriate default URL
+        data.setdefault('level', 0) # Default level
+
+        family_data[person_id] = data
+    return family_data
+
+def load_family_data():
     collection_name = st.secrets["firestore"]["collection_name"]
     try:
-        docs = db.collection(collection_name).stream()
-        family_data = {}
-        for doc in docs:
-            person_id = doc.id
-            data = doc.to_dict()
-            # Ensure lists are correctly handled (Firestore typically preserves list types)
-            # Ensure dates are correctly handled from Firestore (they might be Timestamps)
-            if 'dob' in data and data['dob'] is not None and hasattr(data['dob'], 'isoformat'): # Check if it's a Firestore Timestamp
-                data['dob'] = data['dob'].isoformat().split('T')[0] # Convert to YYYY-MM-DD string
-            if 'dod' in data and data['dod'] is not None and hasattr(data['dod'], 'isoformat'):
-                data['dod'] = data['dod'].isoformat().split('T')[0]
-
-            # Ensure all expected fields are present with default values if missing
-            data.setdefault('given_name', '')
-            data.setdefault('family_name', '')
-            data.setdefault('maiden_name', '')
-            data.setdefault('other_names', '')
-            data.setdefault('nickname', '')
-            data.setdefault('gender', 'Male') # Default gender for existing data
-            data.setdefault('dob', None)
-            data.setdefault('dod', None)
-            data.setdefault('married_to', None)
-            data.setdefault('divorced_from', None)
-            data.setdefault('parents', [])
-            data.setdefault('children', [])
-            data.setdefault('avatar_url', None) # Or appropriate default URL
-            data.setdefault('level', 0) # Default level
-
-            family_data[person_id] = data
-        return family_data
+        # Fresh sessions reuse the cached read instead of streaming the whole collection again
+        return fetch_family_data(collection_name)
     except Exception as e:
         st.error(f"Error loading data from Firestore: {e}")
         return {}
 
-def save_family_data(data):
+def serialize_person(person_data):
+    # Firestore has no set type, so parents/children are stored as sorted lists,
+    # and it stores datetimes (as Timestamps) but not bare dates
+    serialized = {**person_data, 'parents': sorted(person_data['parents']), 'children': sorted(person_data['children'])}
+    for field in ('dob', 'dod'):
+        if isinstance(serialized.get(field), date):
+            serialized[field] = datetime.combine(serialized[field], time.min)
+    return serialized
+
+FIRESTORE_BATCH_LIMIT = 500 # Max operations Firestore accepts in a single WriteBatch
+
+def save_family_data(data, dirty_ids):
+    # Only the people in dirty_ids are compared against what is known to be in Firestore (session
+    # snapshot); those missing from data are deleted, those that differ are written.
+    # Returns True once Firestore matches data, False if the write failed.
+    snapshot = st.session_state.get('family_data_snapshot', {})
+    removed_ids = [person_id for person_id in dirty_ids if person_id not in data and person_id in snapshot]
+    changed_ids = [person_id for person_id in dirty_ids if person_id in data and snapshot.get(person_id) != data[person_id]]
+    if not removed_ids and not changed_ids:
+        return True # Nothing changed since the last load/save
+
     db = get_firestore_client()
     collection_name = st.secrets["firestore"]["collection_name"]
 
     try:
-        # Get existing document IDs to delete them first (to ensure full sync)
-        # This is a simple approach; for large datasets, consider batch updates/deletes or merging.
-        batch = db.batch()
-        current_docs = db.collection(collection_name).stream()
-        for doc in current_docs:
-            batch.delete(doc.reference)
-        batch.commit()
-
-        # Add all current data as new documents
+        collection = db.collection(collection_name)
         batch = db.batch()
-        for person_id, person_data in data.items():
-            # Firestore handles lists and None correctly, but dates should be saved as strings or Timestamps
-            # If dates are datetime.date objects, convert to string for consistent storage
-            if 'dob' in person_data and isinstance(person_data['dob'], date):
-                person_data['dob'] = person_data['dob'].isoformat()
-            if 'dod' in person_data and isinstance(person_data['dod'], date):
-                person_data['dod'] = person_data['dod'].isoformat()
-
-            doc_ref = db.collection(collection_name).document(person_id)
-            batch.set(doc_ref, person_data)
-        batch.commit()
+        batch_ops = 0
+
+        def queued():
+            # Commit and start a new batch whenever the current one reaches Firestore's limit
+            nonlocal batch, batch_ops
+            batch_ops += 1
+            if batch_ops == FIRESTORE_BATCH_LIMIT:
+                batch.commit()
+                batch = db.batch()
+                batch_ops = 0
+
+        for person_id in removed_ids:
+            batch.delete(collection.document(person_id))
+            queued()
+
+        for person_id in changed_ids:
+            batch.set(collection.document(person_id), serialize_person(data[person_id]))
+            queued()
+        if batch_ops:
+            batch.commit()
+
+        # Only the entries that were written need refreshing in the snapshot
+        for person_id in removed_ids:
+            del snapshot[person_id]
+        for person_id in changed_ids:
+            snapshot[person_id] = copy.deepcopy(data[person_id])
+        st.session_state.family_data_snapshot = snapshot
+        fetch_family_data.clear() # The cached read is stale now, for every session
 
         st.toast("Family data successfully saved to Firebase Firestore!", icon="✅")
+        return True
 
     except Exception as e:
         st.error(f"Error saving data to Firebase Firestore: {e}")
+        return False
 
 
 # --- Generation Level Calculation Function ---
 def calculate_generation_levels(family_data):
+    # Writes each person's 'level' in place and returns the IDs whose level changed.
+    # There is no incremental version: a level depends on the visiting order of the whole BFS (both relaxations
+    # below), so a local update cannot reproduce it. Callers skip it only when no level can change.
     if not family_data:
-        return family_data
-
-    # Ensure 'level' is initialized for all
-    for person_id in family_data:
-        family_data[person_id]['level'] = None
-
-    queue = []
+        return set()
+
+    # Number everyone once and pull the relationships into integer adjacency lists (restricted to
+    # people in the dataset), so the BFS below indexes plain lists instead of hashing ID strings.
+    # The relaxations depend on visiting order, so the sets are sorted to keep levels independent of string hashing.
+    person_ids = list(family_data)
+    index_of = {pid: i for i, pid in enumerate(person_ids)}
+    children = [[index_of[c] for c in sorted(data['children']) if c in index_of] for data in family_data.values()]
+    parents = [[index_of[p] for p in sorted(data['parents']) if p in index_of] for data in family_data.values()]
+    level = [None] * len(person_ids) # Every level starts unassigned
+
+    queue = deque()
     base_level = 2 # Starting level for root nodes
 
-    # Identify initial roots (people with no parents or no parents within the current dataset)
-    initial_roots = [
-        pid for pid, data in family_data.items()
-        if not data.get('parents') or all(p not in family_data for p in data.get('parents', []))
-    ]
-
-    for root_id in initial_roots:
-        if family_data[root_id]['level'] is None:
-            family_data[root_id]['level'] = base_level
-            queue.append(root_id)
+    # Initial roots are people with no parents, or no parents within the current dataset;
+    # all of them are queued before the walk starts (multi-source BFS)
+    for root, root_parents in enumerate(parents):
+        if not root_parents:
+            level[root] = base_level
+            queue.append(root)
 
     while queue:
-        current_id = queue.pop(0)
-        current_level = family_data[current_id]['level']
+        current = queue.popleft()
+        current_level = level[current]
 
         # Propagate level to children
-        for child_id in family_data[current_id].get('children', []): # Defensive access
-            if child_id in family_data:
-                if family_data[child_id]['level'] is None:
-                    family_data[child_id]['level'] = current_level + 1
-                    queue.append(child_id)
-                else:
-                    # If already visited, update if a shorter path is found
-                    family_data[child_id]['level'] = min(family_data[child_id]['level'], current_level + 1)
-
-        # Propagate level to parents
-        for parent_id in family_data[current_id].get('parents', []): # Defensive access
-            if parent_id in family_data:
-                if family_data[parent_id]['level'] is None:
-                    family_data[parent_id]['level'] = current_level - 1
-                    queue.append(parent_id)
-                else:
-                    # If already visited, update if a 'higher' parent generation is found
-                    family_data[parent_id]['level'] = max(family_data[parent_id]['level'], current_level - 1)
-
-    # Assign default level to any remaining unassigned nodes (e.g., disconnected nodes)
-    for person_id, data in family_data.items():
-        if data['level'] is None:
-            family_data[person_id]['level'] = base_level
-
-    # Normalize levels so the highest generation starts at 0 or a low number
-    min_level = min(data['level'] for data in family_data.values()) if family_data else 0
-    for person_id in family_data:
-        family_data[person_id]['level'] -= min_level
-
-    return family_data
+        for child in children[current]:
+            if level[child] is None:
+                level[child] = current_level + 1
+                queue.append(child)
+            elif current_level + 1 < level[child]:
+                # If already visited, update if a shorter path is found
+                level[child] = current_level + 1
+
+        # Propagate level to parents. A parent reached through a child before its own ancestors can
+        # sit too low, so this side still needs the relaxation and the first assignment is not final.
+        for parent in parents[current]:
+            if level[parent] is None:
+                level[parent] = current_level - 1
+                queue.append(parent)
+            elif current_level - 1 > level[parent]:
+                # If already visited, update if a 'higher' parent generation is found
+                level[parent] = current_level - 1
+
+    # Assign default level to any remaining unassigned nodes (e.g., disconnected nodes),
+    # tracking the highest generation in the same pass
+    min_level = base_level
+    for i, person_level in enumerate(level):
+        if person_level is None:
+            level[i] = base_level
+        elif person_level < min_level:
+            min_level = person_level
+
+    # Normalize levels so the highest generation starts at 0 or a low number, and write them back
+    changed_ids = set()
+    for (person_id, data), person_level in zip(family_data.items(), level):
+        if data.get('level') != person_level - min_level:
+            data['level'] = person_level - min_level
+            changed_ids.add(person_id)
+    return changed_ids
+
+# --- Reverse Relationship Index ---
+# reverse_index[field][target_id] is the set of people whose `field` points at target_id,
+# e.g. reverse_index['children'][pid] holds everyone who lists pid as a child.
+RELATIONSHIP_FIELDS = ('parents', 'children', 'married_to', 'divorced_from')
+
+def relationship_targets(person_data, field):
+    # 'parents'/'children' hold sets of IDs; 'married_to'/'divorced_from' hold a single ID or None
+    value = person_data.get(field)
+    if not value:
+        return ()
+    return (value,) if isinstance(value, str) else value
+
+def index_person(reverse_index, person_id, person_data):
+    for field in RELATIONSHIP_FIELDS:
+        for target_id in relationship_targets(person_data, field):
+            reverse_index[field].setdefault(target_id, set()).add(person_id)
+
+def unindex_person(reverse_index, person_id, person_data):
+    for field in RELATIONSHIP_FIELDS:
+        for target_id in relationship_targets(person_data, field):
+            referrers = reverse_index[field].get(target_id)
+            if referrers is not None:
+                referrers.discard(person_id)
+                if not referrers:
+                    del reverse_index[field][target_id]
+
+def build_reverse_index(family_data):
+    reverse_index = {field: {} for field in RELATIONSHIP_FIELDS}
+    for person_id, person_data in family_data.items():
+        index_person(reverse_index, person_id, person_data)
+    return reverse_index
+
+def referrers_of(reverse_index, person_ids):
+    """Returns everyone whose relationships point at one of person_ids."""
+    return {pid for person_id in person_ids for field in RELATIONSHIP_FIELDS
+            for pid in reverse_index[field].get(person_id, ())}
+
+def remove_person(family_data, reverse_index, person_id):
+    """Deletes person_id and scrubs every reference to them, visiting only the people who hold one."""
+    referrers = {field: set(reverse_index[field].get(person_id, ())) for field in RELATIONSHIP_FIELDS}
+    touched_ids = set().union(*referrers.values()) - {person_id}
+
+    for pid in touched_ids:
+        unindex_person(reverse_index, pid, family_data[pid])
+    unindex_person(reverse_index, person_id, family_data[person_id])
+
+    for pid in touched_ids:
+        p_data = family_data[pid]
+        p_data['children'].discard(person_id)
+        p_data['parents'].discard(person_id)
+        if pid in referrers['married_to']:
+            p_data['married_to'] = None
+        if pid in referrers['divorced_from']:
+            p_data['divorced_from'] = None
+        index_person(reverse_index, pid, p_data)
+
+    del family_data[person_id]
+    return touched_ids
+
+def collect_cascade(victim_ids, family_data):
+    """Returns victim_ids plus every descendant left with no parents once they are removed."""
+    doomed = set(victim_ids)
+    queue = deque(doomed)
+    while queue:
+        for child_id in family_data[queue.popleft()]['children']:
+            if child_id in doomed or child_id not in family_data:
+                continue
+            if all(parent_id in doomed for parent_id in family_data[child_id]['parents']):
+                doomed.add(child_id)
+                queue.append(child_id)
+    return doomed
+
+# --- Two-way relationships (married_to / divorced_from) ---
+def clear_symmetric(family_data, field, person_id, partner_id):
+    """Clears partner_id's side of field if it still points back at person_id."""
+    partner = family_data.get(partner_id)
+    if partner and partner[field] == person_id:
+        partner[field] = None
+
+def set_symmetric(family_data, field, a, b):
+    """Points a and b at each other through field, provided both are in the tree."""
+    record_a = family_data.get(a)
+    record_b = family_data.get(b)
+    if record_a and record_b:
+        record_a[field] = b
+        record_b[field] = a
+
+# --- Batched Updates ---
+# Adds, edits and deletes only change the in-memory tree and record what they did in
+# st.session_state.dirty_ids; nothing reaches Firestore until the user clicks "Save to Cloud".
+def copy_person(person_data):
+    """Copy of a person record whose parents/children sets can be changed without touching the original."""
+    return dict(person_data, parents=set(person_data['parents']), children=set(person_data['children']))
+
+@contextmanager
+def transaction(state, protected_ids=()):
+    """Applies a group of in-memory edits, then recalculates levels once on exit if flagged.
+
+    The records in protected_ids are copied on entry and put back if the block raises.
+    """
+    backup = {pid: copy_person(state.family_data[pid]) for pid in protected_ids if pid in state.family_data}
+    tx = SimpleNamespace(levels_dirty=False)
+    try:
+        yield tx
+    except Exception:
+        state.family_data.update(backup) # Also restores people the block had already deleted
+        state.reverse_index = build_reverse_index(state.family_data)
+        raise # An exception inside the block skips the recalc
+    if tx.levels_dirty:
+        state.dirty_ids |= calculate_generation_levels(state.family_data)
+
+# --- Avatar encoding (cached on the uploaded bytes) ---
+AVATAR_SIZE = (128, 128) # Nodes draw avatars at ~55px, so this stays sharp on high-DPI screens
+AVATAR_INLINE_LIMIT = 20000 # Inline data URIs longer than this are shrunk when the tree is loaded
+
+@st.cache_data(show_spinner=False)
+def shrink_avatar(raw_bytes):
+    """Downscales an image to fit AVATAR_SIZE and returns (image bytes, mime type)."""
+    image = Image.open(BytesIO(raw_bytes))
+    image_format = 'PNG' if image.format == 'PNG' else 'JPEG' # PNG keeps transparency; photos stay JPEG
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.thumbnail(AVATAR_SIZE)
+    output = BytesIO()
+    image.save(output, format=image_format, optimize=True)
+    return output.getvalue(), f"image/{image_format.lower()}"
+
+def shrink_avatar_data_uri(data_uri):
+    """Re-encodes an inline base64 avatar at AVATAR_SIZE."""
+    encoded_image = data_uri.split(',', 1)[1]
+    return encode_avatar(*shrink_avatar(binascii.a2b_base64(encoded_image)))
+
+@st.cache_data(show_spinner=False)
+def encode_avatar(raw_bytes, mime_type):
+    """Returns the uploaded image as a base64 data URI."""
+    # b2a_base64 is the C routine behind base64.b64encode, without the extra wrapping
+    encoded_image = binascii.b2a_base64(raw_bytes, newline=False).decode('ascii')
+    return f"data:{mime_type};base64,{encoded_image}"
+
+def upload_avatar(raw_bytes, content_type):
+    """Uploads an avatar image to Firebase Storage and returns its public URL."""
+    from firebase_admin import storage
+
+    get_firestore_client() # Make sure the Firebase app is initialized
+    bucket = storage.bucket(st.secrets["firestore"]["storage_bucket"])
+    extension = content_type.split('/')[-1]
+    blob = bucket.blob(f"avatars/{uuid.uuid4()}.{extension}")
+    blob.upload_from_string(raw_bytes, content_type=content_type)
+    blob.make_public()
+    return blob.public_url
 
 # --- Initialize Session State ---
 if 'family_data' not in st.session_state:
     st.session_state.family_data = load_family_data()
-    st.session_state.family_data = calculate_generation_levels(st.session_state.family_data)
+    # What Firestore holds, as loaded; taken before the load-time clean-up below so its changes get saved
+    st.session_state.family_data_snapshot = copy.deepcopy(st.session_state.family_data)
+    st.session_state.dirty_ids = set() # People the user has changed and not yet saved to Firestore
+    # People changed by the load-time clean-up (levels, avatars). They are written with the next save but are
+    # not the user's doing, so they are kept apart from dirty_ids and never counted as unsaved changes.
+    st.session_state.migration_ids = calculate_generation_levels(st.session_state.family_data)
+    st.session_state.reverse_index = build_reverse_index(st.session_state.family_data)
+
+    # One-shot migration: avatars stored inline before uploads were downscaled get shrunk in memory,
+    # and written back once by the next save
+    for person_id, person_data in st.session_state.family_data.items():
+        avatar_url = person_data.get('avatar_url')
+        if avatar_url and avatar_url.startswith("data:image") and len(avatar_url) > AVATAR_INLINE_LIMIT:
+            try:
+                person_data['avatar_url'] = shrink_avatar_data_uri(avatar_url)
+                st.session_state.migration_ids.add(person_id)
+            except Exception:
+                pass # Leave avatars that can't be decoded as they are
+    st.session_state.data_version = 0 # Bumped by every add/edit/delete
 
 # State for the form fields, updated via callback
 if 'form_person_data' not in st.session_state:
@@ -218,6 +514,27 @@ def get_full_name(person_data):
 
     return display_name if display_name else "You"
 
+# Display names are looked up many times per rerun (labels, selectboxes, profile), so they are formatted
+# once per session; add/edit/delete only re-format or drop the entry for the person they change.
+if 'full_name_cache' not in st.session_state:
+    st.session_state.full_name_cache = {pid: get_full_name(data) for pid, data in st.session_state.family_data.items()}
+name_cache = st.session_state.full_name_cache
+
+# People are listed by display name in every dropdown. The sorted lists survive reruns and are only
+# rebuilt once data_version has moved on, so unrelated reruns skip the sort and the list copies.
+if st.session_state.get('person_options_version') != st.session_state.data_version:
+    st.session_state.person_options = sorted(st.session_state.family_data, key=name_cache.__getitem__)
+    st.session_state.blank_person_options = ["", *st.session_state.person_options] # For selectors that start empty
+    st.session_state.blank_person_option_idx = {pid: i for i, pid in enumerate(st.session_state.blank_person_options)}
+    st.session_state.person_options_version = st.session_state.data_version
+person_options = st.session_state.person_options
+blank_person_options = st.session_state.blank_person_options
+
+# --- Helper for resolving avatars ---
+def get_avatar_src(person_data):
+    # A custom avatar wins; otherwise use the default for the person's gender
+    return person_data.get('avatar_url') or AVATAR_BY_GENDER.get(person_data.get('gender'), DEFAULT_NONBINARY_AVATAR_URL)
+
 # --- Callback to update form_person_data when edit selection changes ---
 def update_form_on_edit_select():
     selected_id = st.session_state.edit_person_select_global
@@ -232,12 +549,12 @@ def update_form_on_edit_select():
             'other_names': person_data.get('other_names', ''),
             'nickname': person_data.get('nickname', ''),
             'gender': person_data.get('gender', 'Male'),
-            'dob': date.fromisoformat(person_data['dob']) if person_data.get('dob') else None,
-            'dod': date.fromisoformat(person_data['dod']) if person_data.get('dod') else None,
+            'dob': person_data.get('dob'),
+            'dod': person_data.get('dod'),
             'married_to': person_data.get('married_to', ''),
             'divorced_from': person_data.get('divorced_from', ''),
-            'parents': person_data.get('parents', []),
-            'children': person_data.get('children', []),
+            'parents': sorted(person_data['parents']), # Multiselect defaults need a list
+            'children': sorted(person_data['children']),
             'avatar_url': person_data.get('avatar_url', '')
         }
 
@@ -250,142 +567,203 @@ def update_form_on_edit_select():
             st.session_state.avatar_choice_radio_value = "Upload Image File"
     else:
         # Reset form data when no person is selected or switching mode
-        st.session_state.form_person_data = {
-            'given_name': "", 'family_name': "", 'maiden_name': "",
-            'other_names': "", 'nickname': "", 'gender': "Male",
-            'dob': None, 'dod': None, 'married_to': "",
-            'divorced_from': "", 'parents': [], 'children': [],
-            'avatar_url': ""
-        }
+        st.session_state.form_person_data = dict(_EMPTY_FORM_PERSON_DATA)
         st.session_state.avatar_choice_radio_value = "Use Default (based on gender)"
 
-# --- Family Tree Visualization ---
-st.markdown("<br>", unsafe_allow_html=True)
-st.subheader("Family Tree Visualization")
-
-if not st.session_state.family_data:
-    st.info("The family tree is currently empty. Use the 'Add New Person' section below to get started!")
-else:
-    net = Network(height="700px", width="99%", bgcolor="#f9f9f9", font_color="black", notebook=True)
+# --- Family Tree Rendering (cached on the family data) ---
+# Transparent 1x1 GIF shown in each node until the real avatar is swapped in
+AVATAR_PLACEHOLDER = "data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7"
 
-    net.set_options("""
-    {
-      "layout": {
+# vis.js options, kept as a dict so pyvis doesn't have to parse a JSON string for every render
+PYVIS_OPTIONS = {
+    "layout": {
+        "improvedLayout": False, # Skip vis.js's O(N^2) initial-placement pass; the hierarchical layout positions nodes anyway
         "hierarchical": {
-          "enabled": true,
-          "levelSeparation": 150,
-          "nodeSpacing": 120,
-          "treeSpacing": 220,
-          "direction": "UD",
-          "sortMethod": "directed"
+            "enabled": True,
+            "levelSeparation": 150,
+            "nodeSpacing": 120,
+            "treeSpacing": 220,
+            "direction": "UD",
+            "sortMethod": "directed"
         }
-      },
-      "physics": {
-        "enabled": false
-      },
-      "edges": {
-        "color": { "inherit": "from" },
-        "smooth": { "enabled": true, "type": "cubicBezier", "roundness": 0.6 },
-        "arrows": { "to": { "enabled": false } }
-      }
+    },
+    "physics": {
+        "enabled": False,
+        "stabilization": False
+    },
+    "interaction": {
+        "hideEdgesOnDrag": True, # Edges are the bulk of each frame; skip them while panning/zooming
+        "tooltipDelay": 200
+    },
+    "edges": {
+        "color": {"inherit": "from"},
+        "smooth": {"enabled": False},
+        "arrows": {"to": {"enabled": False}},
+        "chosen": False # Edges have no highlight styling, so don't redraw them on select/hover
     }
-    """)
-
-    for person_id, data in st.session_state.family_data.items():
-        avatar_src = data.get('avatar_url')
-        person_gender = data.get('gender', 'Unknown') # Defensive access for gender
-
-        if not avatar_src:
-            if person_gender == "Male":
-                avatar_src = DEFAULT_MALE_AVATAR_URL
-            elif person_gender == "Female":
-                avatar_src = DEFAULT_FEMALE_AVATAR_URL
-            else: # Catches 'Gender Non-Binary', 'Prefer Not to Say', or 'Unknown'
-                avatar_src = DEFAULT_NONBINARY_AVATAR_URL
+}
+
+@st.cache_resource
+def get_pyvis_template():
+    """Compiles pyvis's Jinja2 HTML template once per server process."""
+    from pyvis.network import Network
+
+    template_net = Network()
+    return template_net.templateEnv.get_template(template_net.path)
+
+def canonical_family_data(family_data):
+    """Immutable, order-independent form of the tree, used as the render cache key."""
+    # Sets are sorted into tuples so equal trees always produce the same key
+    return tuple(sorted(
+        (person_id, tuple(sorted((field, tuple(sorted(value)) if isinstance(value, set) else value)
+                                 for field, value in data.items())))
+        for person_id, data in family_data.items()
+    ))
+
+@st.cache_data(show_spinner=False)
+def render_family_tree_html(family_snapshot):
+    """Builds the pyvis network for a canonical_family_data() snapshot and returns the HTML to embed."""
+    from pyvis.network import Network # Only needed when the graph actually has to be rebuilt
+
+    family_data = {person_id: dict(fields) for person_id, fields in family_snapshot}
+    net = Network(height="700px", width="99%", bgcolor="#f9f9f9", font_color="black")
+    net.options = PYVIS_OPTIONS
+    net.template = get_pyvis_template()
+
+    # Build the vis.js node/edge dicts directly instead of going through net.add_node/net.add_edge,
+    # which validate every call and scan all existing edges for duplicates
+    names = {pid: get_full_name(data) for pid, data in family_data.items()}
+    nodes = []
+    for person_id, data in family_data.items():
+        avatar_src = get_avatar_src(data)
 
-        display_name_for_node = get_full_name(data)
+        display_name_for_node = names[person_id]
         # Use .get() for 'married_to' and 'divorced_from' to prevent errors if they are missing
-        married_to_id = data.get('married_to')
-        married_to_name = get_full_name(st.session_state.family_data[married_to_id]) if married_to_id and married_to_id in st.session_state.family_data else "N/A"
-        divorced_from_id = data.get('divorced_from')
-        divorced_from_name = get_full_name(st.session_state.family_data[divorced_from_id]) if divorced_from_id and divorced_from_id in st.session_state.family_data else "N/A"
-
-
-        tooltip_info = (
-            f"Full Name: {get_full_name(data)}\n"
-            f"Given Name: {data.get('given_name', 'N/A')}\n"
-            f"Family Name: {data.get('family_name', 'N/A')}\n"
-            f"Maiden Name: {data.get('maiden_name', 'N/A')}\n"
-            f"Other Names: {data.get('other_names', 'N/A')}\n"
-            f"Nickname: {data.get('nickname', 'N/A')}\n"
-            f"Born: {data.get('dob', 'N/A')}\n"
-            f"Died: {data.get('dod', 'N/A')}\n"
-            f"Married To: {married_to_name}\n"
-            f"Divorced From: {divorced_from_name}"
-        )
-
-        net.add_node(
-            person_id,
-            label=display_name_for_node,
-            title=tooltip_info,
-            level=data.get('level', 0), # Defensive access for level
-            shape='circularImage',
-            image=avatar_src,
-            size=55,
-            font={"size": 14, "color": "#333333"},
-            color={
+        married_to_name = names.get(data.get('married_to'), "N/A")
+        divorced_from_name = names.get(data.get('divorced_from'), "N/A")
+
+        tooltip_info = "\n".join((
+            f"Full Name: {display_name_for_node}",
+            f"Given Name: {data.get('given_name', 'N/A')}",
+            f"Family Name: {data.get('family_name', 'N/A')}",
+            f"Maiden Name: {data.get('maiden_name', 'N/A')}",
+            f"Other Names: {data.get('other_names', 'N/A')}",
+            f"Nickname: {data.get('nickname', 'N/A')}",
+            f"Born: {data.get('dob', 'N/A')}",
+            f"Died: {data.get('dod', 'N/A')}",
+            f"Married To: {married_to_name}",
+            f"Divorced From: {divorced_from_name}",
+        ))
+
+        nodes.append({
+            "id": person_id,
+            "label": display_name_for_node,
+            "title": tooltip_info,
+            "level": data.get('level', 0), # Defensive access for level
+            "shape": 'circularImage',
+            "image": AVATAR_PLACEHOLDER, # Swapped for "avatar" after the first draw, see lazy_avatars below
+            "avatar": avatar_src,
+            "size": 55,
+            "font": {"size": 14, "color": "#333333"},
+            "color": {
                 "border": "#666666",
                 "background": "#ffffff",
                 "highlight": {"border": "#0057b7", "background": "#cce5ff"},
                 "hover": {"border": "#003d80", "background": "#99ccff"}
             },
-        )
+        })
 
-    for person_id, data in st.session_state.family_data.items():
-        # Defensive access for 'children' list
-        for child in data.get("children", []):
-            if child in st.session_state.family_data:
-                net.add_edge(person_id, child, color="#999999", width=1.7)
-
-    drawn_spouse_edges = set()
-    for person_id, data in st.session_state.family_data.items():
-        married_to_id = data.get('married_to')
-        if married_to_id and married_to_id in st.session_state.family_data:
-            # Defensive access for 'married_to' inside the linked person
-            if st.session_state.family_data[married_to_id].get('married_to') == person_id:
-                edge_key = tuple(sorted((person_id, married_to_id)))
-                if edge_key not in drawn_spouse_edges:
-                    net.add_edge(person_id, married_to_id, color="#bbbbbb", dashes=True, width=2)
-                    drawn_spouse_edges.add(edge_key)
+    edges = [
+        {"from": person_id, "to": child, "color": "#999999", "width": 1.7}
+        for person_id, data in family_data.items()
+        for child in data["children"]
+        if child in family_data
+    ]
+
+    # Only mutual marriages get an edge. Each couple is emitted once, from the partner with the smaller ID,
+    # which also rules out self-marriages without building a set of pairs.
+    edges.extend(
+        {"from": person_id, "to": data['married_to'], "color": "#bbbbbb", "dashes": True, "width": 2}
+        for person_id, data in family_data.items()
+        if data.get('married_to') and data['married_to'] > person_id
+        and family_data.get(data['married_to'], {}).get('married_to') == person_id
+    )
 
+    net.nodes = nodes
+    net.edges = edges
+
+    # Render in memory instead of writing family_tree.html and reading it back.
+    # notebook=True makes pyvis render with net.template (the cached one) instead of recompiling it.
+    html_data = net.generate_html(notebook=True)
+
+    css_fix = """
+    <style>
+        body {
+            margin: 0 !important;
+            padding: 0 !important;
+            overflow: hidden;
+        }
+        html {
+            overflow: hidden;
+        </style>
+    """
+    # Draw the tree with placeholder images first, then point every node at its real avatar.
+    # The canvas no longer waits on a burst of avatar downloads before it can paint.
+    lazy_avatars = """
+    <script type="text/javascript">
+        network.once("afterDrawing", function () {
+            nodes.update(nodes.get().map(function (node) {
+                return {id: node.id, image: node.avatar};
+            }));
+        });
+    </script>
+    """
+    html_data = html_data.replace("</head>", css_fix + "</head>")
+    return html_data.replace("</body>", lazy_avatars + "</body>")
+
+# --- Unsaved Changes ---
+pending_count = len(st.session_state.dirty_ids)
+if pending_count:
+    badge_col, save_col = st.columns([4, 1])
+    badge_col.warning(f"{pending_count} {'people have' if pending_count != 1 else 'person has'} unsaved changes. Unsaved changes are lost when this session ends.")
+    if save_col.button("💾 Save to Cloud", key="flush_pending_ops"):
+        # save_family_data checks each dirty person against the Firestore snapshot, so edits that cancel out write nothing
+        if save_family_data(st.session_state.family_data, st.session_state.dirty_ids | st.session_state.migration_ids):
+            st.session_state.dirty_ids = set()
+            st.session_state.migration_ids = set()
+            st.rerun()
+
+# --- Family Tree Visualization ---
+st.markdown("<br>", unsafe_allow_html=True)
+st.subheader("Family Tree Visualization")
+
+if not st.session_state.family_data:
+    st.info("The family tree is currently empty. Use the 'Add New Person' section below to get started!")
+else:
     try:
-        net.save_graph("family_tree.html")
+        # Reruns that don't change the tree (selectbox changes, typing in the form) reuse this session's
+        # last HTML; a 16-byte digest of the snapshot is far cheaper to compare than st.cache_data's
+        # recursive hash of it. A changed tree still goes through the shared render cache.
+        family_snapshot = canonical_family_data(st.session_state.family_data)
+        graph_hash = hashlib.blake2b(repr(family_snapshot).encode(), digest_size=16).digest()
+        if st.session_state.get('last_graph_hash') == graph_hash:
+            html_data = st.session_state.last_graph_html
+        else:
+            html_data = render_family_tree_html(family_snapshot)
+            st.session_state.last_graph_hash = graph_hash
+            st.session_state.last_graph_html = html_data
+    except Exception as e:
+        st.error(f"Error generating graph: {e}")
+        st.warning("This might happen if the family data becomes too complex or contains invalid relationships. Try simplifying or checking for circular references.")
+    else:
         with st.container():
             st.markdown(
                 """
                 <div style="border: 2px solid #ddd; border-radius: 10px; padding: 15px; background-color: #ffffff;">
                 """
                 , unsafe_allow_html=True)
-            with open("family_tree.html", "r", encoding="utf-8") as f:
-                html_data = f.read()
-
-                css_fix = """
-                <style>
-                    body {
-                        margin: 0 !important;
-                        padding: 0 !important;
-                        overflow: hidden;
-                    }
-                    html {
-                        overflow: hidden;
-                    </style>
-                """
-                html_data = html_data.replace("</head>", css_fix + "</head>")
-                components.html(html_data, height=700, scrolling=False)
+            components.html(html_data, height=700, scrolling=False)
             st.markdown("</div>", unsafe_allow_html=True)
-    except Exception as e:
-        st.error(f"Error generating graph: {e}")
-        st.warning("This might happen if the family data becomes too complex or contains invalid relationships. Try simplifying or checking for circular references.")
 
 st.markdown("<br><hr><br>", unsafe_allow_html=True)
 
@@ -400,15 +778,15 @@ else:
     with col1:
         selected_person_id_display = st.selectbox(
             "Select a person:",
-            options=[""] + list(st.session_state.family_data.keys()),
-            format_func=lambda x: get_full_name(st.session_state.family_data[x]) if x else "Select a person...",
+            options=blank_person_options,
+            format_func=lambda x: name_cache[x] if x else "Select a person...",
             key="profile_select"
         )
 
     with col2:
         if selected_person_id_display:
             p = st.session_state.family_data[selected_person_id_display]
-            st.markdown(f"### {get_full_name(p)}")
+            st.markdown(f"### {name_cache[selected_person_id_display]}")
             st.write(f"**Unique ID:** `{selected_person_id_display}`")
             st.write(f"**Generation Level:** {p.get('level', 'N/A')}")
             st.write(f"**Gender:** {p.get('gender', 'N/A')}") # Safely display gender
@@ -418,19 +796,8 @@ else:
             st.write(f"**Other Names:** {p.get('other_names', 'N/A')}")
             st.write(f"**Nickname:** {p.get('nickname', 'N/A')}")
 
-            current_avatar_url = p.get('avatar_url')
-            person_gender_display = p.get('gender', 'Unknown') # Safely get gender
-
-            if not current_avatar_url:
-                if person_gender_display == "Male":
-                    current_avatar_url = DEFAULT_MALE_AVATAR_URL
-                elif person_gender_display == "Female":
-                    current_avatar_url = DEFAULT_FEMALE_AVATAR_URL
-                else:
-                    current_avatar_url = DEFAULT_NONBINARY_AVATAR_URL
-
             st.write("Current Avatar:")
-            st.image(current_avatar_url, width=100)
+            st.image(get_avatar_src(p), width=100)
 
             if p.get('avatar_url'):
                 if p['avatar_url'].startswith("data:image"):
@@ -445,25 +812,24 @@ else:
 
             married_to_id = p.get('married_to')
             if married_to_id and married_to_id in st.session_state.family_data:
-                st.write(f"**Married To:** {get_full_name(st.session_state.family_data[married_to_id])}")
+                st.write(f"**Married To:** {name_cache[married_to_id]}")
             else:
                 st.write("**Married To:** N/A")
 
             divorced_from_id = p.get('divorced_from')
             if divorced_from_id and divorced_from_id in st.session_state.family_data:
-                st.write(f"**Divorced From:** {get_full_name(st.session_state.family_data[divorced_from_id])}")
+                st.write(f"**Divorced From:** {name_cache[divorced_from_id]}")
             else:
                 st.write("**Divorced From:** N/A")
 
-            # Defensive access for 'parents' and 'children' when displaying
-            if p.get('parents'):
-                parents_names = ", ".join(get_full_name(st.session_state.family_data[p_id]) for p_id in p['parents'] if p_id in st.session_state.family_data)
+            if p['parents']:
+                parents_names = ", ".join(name_cache[p_id] for p_id in p['parents'] if p_id in name_cache)
                 st.write(f"**Parents:** {parents_names}")
             else:
                 st.write("**Parents:** None listed")
 
-            if p.get('children'):
-                children_names = ", ".join(get_full_name(st.session_state.family_data[c_id]) for c_id in p['children'] if c_id in st.session_state.family_data)
+            if p['children']:
+                children_names = ", ".join(name_cache[c_id] for c_id in p['children'] if c_id in name_cache)
                 st.write(f"**Children:** {children_names}")
             else:
                 st.write("**Children:** None listed")
@@ -478,13 +844,7 @@ mode = st.radio("Choose mode:", ("Add New Person", "Edit Existing Person"), key=
 # Logic to reset form data when switching to "Add New Person" mode
 if mode == "Add New Person" and st.session_state.edit_mode_selected_id != "":
     st.session_state.edit_mode_selected_id = ""
-    st.session_state.form_person_data = { # Ensure all fields are initialized defensively
-        'given_name': "", 'family_name': "", 'maiden_name': "",
-        'other_names': "", 'nickname': "", 'gender': "Male",
-        'dob': None, 'dod': None, 'married_to': "",
-        'divorced_from': "", 'parents': [], 'children': [],
-        'avatar_url': ""
-    }
+    st.session_state.form_person_data = dict(_EMPTY_FORM_PERSON_DATA) # Ensure all fields are initialized defensively
     st.session_state.avatar_choice_radio_value = "Use Default (based on gender)"
     st.rerun()
 
@@ -497,9 +857,9 @@ if mode == "Edit Existing Person":
     else:
         selected_person_edit_id = st.selectbox(
             "Select person to edit:",
-            options=[""] + list(st.session_state.family_data.keys()),
-            index=(list(st.session_state.family_data.keys()).index(st.session_state.edit_mode_selected_id) + 1 if st.session_state.edit_mode_selected_id and st.session_state.edit_mode_selected_id in st.session_state.family_data else 0),
-            format_func=lambda x: get_full_name(st.session_state.family_data[x]) if x else "Select a person...",
+            options=blank_person_options,
+            index=st.session_state.blank_person_option_idx.get(st.session_state.edit_mode_selected_id, 0),
+            format_func=lambda x: name_cache[x] if x else "Select a person...",
             key="edit_person_select_global",
             on_change=update_form_on_edit_select
         )
@@ -550,6 +910,7 @@ with st.form(f"person_form_{st.session_state.form_counter}"):
     )
 
     final_avatar_data_to_store = None
+    avatar_upload = None # (bytes, content type) pushed to Firebase Storage on submit
 
     if avatar_choice == "Provide Image URL":
         avatar_url = st.text_input(
@@ -569,16 +930,24 @@ with st.form(f"person_form_{st.session_state.form_counter}"):
         uploaded_file = st.file_uploader(
             "Upload New Avatar Image File (overwrites previous custom image):",
             type=["png", "jpg", "jpeg"],
-            help="Upload a small image file (PNG, JPG). Larger files will increase the size of your family_data.json.",
+            help="Upload an image file (PNG, JPG). It is shrunk to a 128x128 thumbnail before it is stored.",
             key="avatar_file_uploader"
         )
         if uploaded_file is not None:
             st.image(uploaded_file, caption="New Uploaded Image Preview", width=150)
-            image_bytes = uploaded_file.getvalue()
-            encoded_image = base64.b64encode(image_bytes).decode('utf-8')
-            mime_type = f"image/{uploaded_file.type.split('/')[-1]}"
-            final_avatar_data_to_store = f"data:{mime_type};base64,{encoded_image}"
-            st.success("Image uploaded and ready for storage.")
+            try:
+                # Avatars are stored at thumbnail size; reruns with the same file reuse the cached result
+                with st.spinner("Processing avatar..."):
+                    image_bytes, mime_type = shrink_avatar(uploaded_file.getvalue())
+            except Exception as e:
+                st.error(f"Could not read the uploaded image: {e}")
+            else:
+                if st.secrets["firestore"].get("storage_bucket"):
+                    # Keep the image bytes out of the Firestore document; only the URL is stored
+                    avatar_upload = (image_bytes, mime_type)
+                else:
+                    final_avatar_data_to_store = encode_avatar(image_bytes, mime_type)
+                st.success("Image uploaded and ready for storage.")
 
 
     gender = st.selectbox("Gender:", gender_options, index=gender_idx, key="gender_select")
@@ -598,35 +967,35 @@ with st.form(f"person_form_{st.session_state.form_counter}"):
         key="dod_input"
     )
 
-    all_person_ids = sorted(list(st.session_state.family_data.keys()))
-    available_relationship_options = [pid for pid in all_person_ids if pid != person_id_to_process]
+    available_relationship_options = [pid for pid in person_options if pid != person_id_to_process]
     available_relationship_options_with_none = [""] + available_relationship_options
+    relationship_option_idx = {pid: i for i, pid in enumerate(available_relationship_options_with_none)}
 
     married_to = st.selectbox(
         "Married to (select existing person):",
         options=available_relationship_options_with_none,
-        index=available_relationship_options_with_none.index(married_to_val) if married_to_val in available_relationship_options_with_none else 0,
-        format_func=lambda x: get_full_name(st.session_state.family_data[x]) if x in st.session_state.family_data else "N/A",
+        index=relationship_option_idx.get(married_to_val, 0),
+        format_func=lambda x: name_cache.get(x, "N/A"),
         key="married_to_select_form"
     )
 
     divorced_from = st.selectbox(
         "Divorced from (select existing person):",
         options=available_relationship_options_with_none,
-        index=available_relationship_options_with_none.index(divorced_from_val) if divorced_from_val in available_relationship_options_with_none else 0,
-        format_func=lambda x: get_full_name(st.session_state.family_data[x]) if x in st.session_state.family_data else "N/A",
+        index=relationship_option_idx.get(divorced_from_val, 0),
+        format_func=lambda x: name_cache.get(x, "N/A"),
         key="divorced_from_select_form"
     )
 
     parents = st.multiselect("Parents (select existing people):",
                              options=available_relationship_options,
                              default=initial_parents,
-                             format_func=lambda x: get_full_name(st.session_state.family_data[x]) if x in st.session_state.family_data else x,
+                             format_func=lambda x: name_cache.get(x, x),
                              key="parents_select_form")
     children = st.multiselect("Children (select existing people):",
                               options=available_relationship_options,
                               default=initial_children,
-                              format_func=lambda x: get_full_name(st.session_state.family_data[x]) if x in st.session_state.family_data else x,
+                              format_func=lambda x: name_cache.get(x, x),
                               key="children_select_form")
 
     submitted = st.form_submit_button("Submit")
@@ -636,7 +1005,7 @@ with st.form(f"person_form_{st.session_state.form_counter}"):
             if not given_name:
                 st.error("Given Name is required to add a new person.")
                 st.stop()
-            person_id_to_process = str(uuid.uuid4())
+            person_id_to_process = uuid.uuid4().hex # Existing people keep their hyphenated IDs
         else:
             if not st.session_state.edit_mode_selected_id:
                 st.error("Please select a person to edit using the dropdown above the form.")
@@ -646,6 +1015,12 @@ with st.form(f"person_form_{st.session_state.form_counter}"):
                 st.stop()
             person_id_to_process = st.session_state.edit_mode_selected_id
 
+        if avatar_upload is not None:
+            try:
+                final_avatar_data_to_store = upload_avatar(*avatar_upload)
+            except Exception as e:
+                st.error(f"Error uploading avatar to Firebase Storage: {e}")
+                st.stop()
 
         # Safely get old relationships to properly update them
         old_parents = st.session_state.family_data.get(person_id_to_process, {}).get('parents', [])
@@ -661,66 +1036,91 @@ with st.form(f"person_form_{st.session_state.form_counter}"):
             "nickname": nickname if nickname else None,
             "avatar_url": final_avatar_data_to_store,
             "gender": gender,
-            "dob": dob.isoformat() if dob else None,
-            "dod": dod.isoformat() if dod else None,
+            "dob": dob,
+            "dod": dod,
             "married_to": married_to if married_to else None,
             "divorced_from": divorced_from if divorced_from else None,
-            "children": children,
-            "parents": parents,
-            "level": 0 # Level will be recalculated by calculate_generation_levels
+            "children": set(children),
+            "parents": set(parents),
+            # Kept as-is unless the relationships change, in which case calculate_generation_levels redoes it
+            "level": st.session_state.family_data.get(person_id_to_process, {}).get('level', 0)
         }
 
-        st.session_state.family_data[person_id_to_process] = new_person_data
-        st.success(f"Successfully {'added' if mode == 'Add New Person' else 'updated'} {get_full_name(new_person_data)}!")
+        # Resubmitting an unchanged person would only rewrite the same relationships and levels
+        existing_person_data = st.session_state.family_data.get(person_id_to_process)
+        if existing_person_data is not None and all(
+                existing_person_data.get(field) == value for field, value in new_person_data.items() if field != 'level'):
+            st.toast(f"No changes to {get_full_name(new_person_data)}.", icon="ℹ️")
+            st.session_state.form_counter += 1 # Increment to force form reset
+            st.session_state.form_person_data = dict(_EMPTY_FORM_PERSON_DATA)
+            st.session_state.edit_mode_selected_id = ""
+            st.session_state.avatar_choice_radio_value = "Use Default (based on gender)"
+            st.rerun()
+
+        # Everyone whose record this submit can touch. The relationship updates below work on copies of
+        # their records, which are swapped into the tree together once all of them have succeeded.
+        related_ids = {person_id_to_process, old_married_to, married_to, old_divorced_from, divorced_from}
+        related_ids.update(old_parents, parents, old_children, children)
+        patches = {r_id: copy_person(st.session_state.family_data[r_id])
+                   for r_id in related_ids if r_id in st.session_state.family_data}
+        patches[person_id_to_process] = new_person_data
 
         old_parents_set = set(old_parents)
         new_parents_set = set(parents)
         old_children_set = set(old_children)
         new_children_set = set(children)
 
-        # Update parent's children list
-        for p_id in (old_parents_set - new_parents_set):
-            if p_id in st.session_state.family_data and person_id_to_process in st.session_state.family_data[p_id].get('children', []):
-                st.session_state.family_data[p_id]['children'].remove(person_id_to_process)
-        for p_id in (new_parents_set - old_parents_set):
-            if p_id in st.session_state.family_data and person_id_to_process not in st.session_state.family_data[p_id].get('children', []):
-                st.session_state.family_data[p_id].setdefault('children', []).append(person_id_to_process)
-
-        # Update child's parents list
-        for c_id in (old_children_set - new_children_set):
-            if c_id in st.session_state.family_data and person_id_to_process in st.session_state.family_data[c_id].get('parents', []):
-                st.session_state.family_data[c_id]['parents'].remove(person_id_to_process)
-        for c_id in (new_children_set - old_children_set):
-            if c_id in st.session_state.family_data and person_id_to_process not in st.session_state.family_data[c_id].get('parents', []):
-                st.session_state.family_data[c_id].setdefault('parents', []).append(person_id_to_process)
-
-        # Update spouse relationships
-        if old_married_to and old_married_to in st.session_state.family_data and st.session_state.family_data[old_married_to].get('married_to') == person_id_to_process:
-            st.session_state.family_data[old_married_to]['married_to'] = None
-        if married_to and married_to in st.session_state.family_data:
-            st.session_state.family_data[married_to]['married_to'] = person_id_to_process
-            st.session_state.family_data[person_id_to_process]['married_to'] = married_to
-
-        # Update divorced_from relationships
-        if old_divorced_from and old_divorced_from in st.session_state.family_data and st.session_state.family_data[old_divorced_from].get('divorced_from') == person_id_to_process:
-            st.session_state.family_data[old_divorced_from]['divorced_from'] = None
-        if divorced_from and divorced_from in st.session_state.family_data:
-            st.session_state.family_data[divorced_from]['divorced_from'] = person_id_to_process
-            st.session_state.family_data[person_id_to_process]['divorced_from'] = divorced_from
-
-        st.session_state.family_data = calculate_generation_levels(st.session_state.family_data)
-        save_family_data(st.session_state.family_data)
+        # Update parent's children set; only parents that were added or dropped need a change
+        for p_id in old_parents_set ^ new_parents_set:
+            p_data = patches.get(p_id)
+            if p_data is None:
+                continue
+            if p_id in new_parents_set:
+                p_data['children'].add(person_id_to_process)
+            else:
+                p_data['children'].discard(person_id_to_process)
+
+        # Update child's parents set
+        for c_id in old_children_set ^ new_children_set:
+            c_data = patches.get(c_id)
+            if c_data is None:
+                continue
+            if c_id in new_children_set:
+                c_data['parents'].add(person_id_to_process)
+            else:
+                c_data['parents'].discard(person_id_to_process)
+
+        # Update spouse and divorced_from relationships
+        clear_symmetric(patches, 'married_to', person_id_to_process, old_married_to)
+        set_symmetric(patches, 'married_to', person_id_to_process, married_to)
+        clear_symmetric(patches, 'divorced_from', person_id_to_process, old_divorced_from)
+        set_symmetric(patches, 'divorced_from', person_id_to_process, divorced_from)
+
+        # Swap the patched records in, refreshing their reverse-index entries around the update
+        reverse_index = st.session_state.reverse_index
+        for r_id in patches:
+            if r_id in st.session_state.family_data:
+                unindex_person(reverse_index, r_id, st.session_state.family_data[r_id])
+        st.session_state.family_data.update(patches)
+        for r_id, r_data in patches.items():
+            index_person(reverse_index, r_id, r_data)
+        st.success(f"Successfully {'added' if mode == 'Add New Person' else 'updated'} {get_full_name(new_person_data)}!")
+        name_cache[person_id_to_process] = get_full_name(st.session_state.family_data[person_id_to_process])
+        st.session_state.data_version += 1
+
+        # Levels only depend on parent/child links, so edits that leave those alone keep everyone's level.
+        # Otherwise the full pass runs (see calculate_generation_levels), so the saved levels match what the next load computes.
+        if mode == 'Add New Person' or old_parents_set != new_parents_set or old_children_set != new_children_set:
+            level_changed_ids = calculate_generation_levels(st.session_state.family_data)
+        else:
+            level_changed_ids = set()
+        st.session_state.dirty_ids.update(patches)
+        st.session_state.dirty_ids |= level_changed_ids
 
         st.session_state.form_counter += 1 # Increment to force form reset
 
         # Reset form data for next entry/edit
-        st.session_state.form_person_data = {
-            'given_name': "", 'family_name': "", 'maiden_name': "",
-            'other_names': "", 'nickname': "", 'gender': "Male",
-            'dob': None, 'dod': None, 'married_to': "",
-            'divorced_from': "", 'parents': [], 'children': [],
-            'avatar_url': ""
-        }
+        st.session_state.form_person_data = dict(_EMPTY_FORM_PERSON_DATA)
         st.session_state.edit_mode_selected_id = ""
         st.session_state.avatar_choice_radio_value = "Use Default (based on gender)"
 
@@ -735,88 +1135,64 @@ if not st.session_state.family_data:
     st.info("No people to delete. The family tree is empty.")
 else:
     with st.form("delete_person_form"):
-        person_to_delete_id = st.selectbox(
-            "Select a person to delete:",
-            options=[""] + list(st.session_state.family_data.keys()),
-            format_func=lambda x: get_full_name(st.session_state.family_data[x]) if x else "Select a person...",
+        people_to_delete_ids = st.multiselect(
+            "Select people to delete:",
+            options=person_options,
+            format_func=lambda x: name_cache.get(x, x),
             key="delete_person_select"
         )
+        delete_orphans = st.checkbox("Also delete orphaned descendants", key="delete_orphans_checkbox")
 
-        if person_to_delete_id:
-            st.warning(f"You are about to delete **{get_full_name(st.session_state.family_data[person_to_delete_id])}**.")
-            st.warning("This action cannot be undone. All relationships to this person will also be removed.")
+        if people_to_delete_ids:
+            st.warning(f"You are about to delete **{', '.join(name_cache.get(x, x) for x in people_to_delete_ids)}**.")
+            st.warning("This action cannot be undone. All relationships to these people will also be removed.")
 
         delete_confirmed = st.form_submit_button("Confirm Delete")
 
-        if delete_confirmed and person_to_delete_id:
-            person_name = get_full_name(st.session_state.family_data[person_to_delete_id])
-
-            for p_id, p_data in st.session_state.family_data.items():
-                if p_id == person_to_delete_id:
-                    continue
-
-                # Defensive checks when removing relationships
-                if person_to_delete_id in p_data.get('children', []):
-                    st.session_state.family_data[p_id]['children'].remove(person_to_delete_id)
-
-                if person_to_delete_id in p_data.get('parents', []):
-                    st.session_state.family_data[p_id]['parents'].remove(person_to_delete_id)
-
-                if p_data.get('married_to') == person_to_delete_id:
-                    st.session_state.family_data[p_id]['married_to'] = None
-
-                if p_data.get('divorced_from') == person_to_delete_id:
-                    st.session_state.family_data[p_id]['divorced_from'] = None
-
-            del st.session_state.family_data[person_to_delete_id]
-            st.success(f"Successfully deleted {person_name}.")
-
-            st.session_state.family_data = calculate_generation_levels(st.session_state.family_data)
-            save_family_data(st.session_state.family_data)
-
-            # Reset edit mode if the deleted person was being edited
-            if st.session_state.edit_mode_selected_id == person_to_delete_id:
+        # A repeated submit can name people who are already gone; with nobody left to remove
+        # there is nothing to recalculate, save or redraw
+        existing_ids = [x for x in people_to_delete_ids if x in st.session_state.family_data]
+
+        if delete_confirmed and existing_ids:
+            # Collect the full set of victims before mutating anything
+            people_to_delete_ids = existing_ids
+            if delete_orphans:
+                people_to_delete_ids = collect_cascade(people_to_delete_ids, st.session_state.family_data)
+            deleted_names = [name_cache[x] for x in people_to_delete_ids]
+
+            # Everyone the scrub rewrites is backed up, so a failure part-way leaves the tree as it was; the name
+            # cache, data_version and dirty_ids are only touched after the block has succeeded
+            protected_ids = set(people_to_delete_ids) | referrers_of(st.session_state.reverse_index, people_to_delete_ids)
+            with transaction(st.session_state, protected_ids) as tx:
+                # Levels are recalculated once for the whole batch, after the scrub. People with no parents or
+                # children sit apart from everyone else in the level calculation, so deleting only such people
+                # cannot move anyone's level; any other delete needs the full pass.
+                tx.levels_dirty = any(st.session_state.family_data[x]['parents'] or st.session_state.family_data[x]['children']
+                                      for x in people_to_delete_ids)
+
+                touched_ids = set()
+                for person_to_delete_id in people_to_delete_ids:
+                    touched_ids |= remove_person(st.session_state.family_data, st.session_state.reverse_index, person_to_delete_id)
+
+            for person_to_delete_id in people_to_delete_ids:
+                del name_cache[person_to_delete_id]
+            st.session_state.dirty_ids |= touched_ids | set(people_to_delete_ids) # Victims are deleted on save
+            st.session_state.data_version += 1
+            st.success(f"Successfully deleted {', '.join(deleted_names)}.")
+
+            # Reset edit mode if a deleted person was being edited
+            if st.session_state.edit_mode_selected_id in people_to_delete_ids:
                 st.session_state.edit_mode_selected_id = ""
-                st.session_state.form_person_data = {
-                    'given_name': "", 'family_name': "", 'maiden_name': "",
-                    'other_names': "", 'nickname': "", 'gender': "Male",
-                    'dob': None, 'dod': None, 'married_to': "",
-                    'divorced_from': "", 'parents': [], 'children': [],
-                    'avatar_url': ""
-                }
+                st.session_state.form_person_data = dict(_EMPTY_FORM_PERSON_DATA)
                 st.session_state.avatar_choice_radio_value = "Use Default (based on gender)"
 
             st.rerun()
-        elif delete_confirmed and not person_to_delete_id:
-            st.error("Please select a person to delete.")
+        elif delete_confirmed and people_to_delete_ids:
+            st.info("The selected people have already been deleted.")
+        elif delete_confirmed:
+            st.error("Please select at least one person to delete.")
 
 st.markdown("<br>", unsafe_allow_html=True)
 
-st.info(
-    """
-    **Notes:**
-    - Nodes use circular avatar images.
-    - Hover nodes to see detailed tooltip.
-    - Edges show parent-child relationships.
-    - Dashed edges show spouse relationships.
-    - Tree layout is vertical and hierarchical for clarity.
-    - **Data is now saved to and loaded from Firebase Firestore!** This enables persistence for deployed apps.
-    - Generation levels are now automatically calculated based on parent/child relationships.
-    - New person IDs are automatically generated.
-    - Date of Birth, Date of Death, Married To, and Divorced From fields have been added.
-    - Name fields are now separated into Given Name, Family Name, Maiden Name, Other Names, and Nickname.
-    - Date range for birth/death is expanded to allow older dates.
-    - You can now choose a custom Avatar Image by providing a URL or uploading an image file!
-        - Uploaded images are converted to a Base64 string and stored in Firestore.
-        - **Warning:** Uploading large image files will significantly increase the size of your Firestore documents and can impact app performance. Please use small, optimized images for avatars.
-    - Form fields for editing now update immediately when you select a person from the dropdown.
-    - A new 'Delete Person' section has been added to remove individuals from the tree.
-        - Deleting a person will also automatically remove all their associated relationships (parent, child, spouse) from other individuals in the tree.
-        - A confirmation step is included to prevent accidental deletion.
-    - The empty band (horizontal scrollbar) above the visualization should now be removed! This was achieved by:
-        - Setting `width=\"99%\"` for the `pyvis.Network`.
-        - Setting `scrolling=False` for `st.components.v1.html`.
-        - Injecting custom CSS into the generated HTML to remove default `margin` and `padding` from the `body` and `html` tags within the iframe, and setting `overflow: hidden;`.
-    - New Gender Options: Added "Gender Non-Binary" and "Prefer Not to Say" options for gender selection, with a neutral default avatar.
-    """
-)
\ No newline at end of file
+with st.expander("Notes", expanded=False): # Collapsed, so the long list stays out of the way
+    st.markdown(NOTES)